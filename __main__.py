@@ -1,6 +1,14 @@
-from numpy import log2
 from .fsm import FSM
 from argparse import ArgumentParser
+import logging
+import re
+
+_TOKEN_RE = re.compile(r"[0-9a-fA-F]{128}")
+
+
+def _is_pow2(n: int) -> bool:
+    return n > 0 and (n & (n - 1)) == 0
+
 
 parser = ArgumentParser(prog="quantum_fsm")
 
@@ -32,33 +40,73 @@ parser.add_argument(
     help="Execute the algorithm locally using QASM simulator with matrix_product_state method",
 )
 parser.add_argument("-b", "--backend", default="ibm_sherbrooke", help="IBM backend name")
+parser.add_argument(
+    "--draw",
+    default="none",
+    help="Save a drawing of the whole circuit to the current working directory once it is built",
+    choices=["none", "text", "mpl"],
+)
+parser.add_argument(
+    "--opt-levels",
+    default="1",
+    help="Comma separated transpiler optimization levels to try, keeping the lowest depth circuit (ignored when executing locally)",
+)
+parser.add_argument(
+    "--batch-size",
+    default=1,
+    help="Number of jobs to split the shots into, submitted together as a single Qiskit Runtime batch (ignored when executing locally)",
+    type=int,
+)
 
 args = parser.parse_args()
 
+# show the algorithm progress without enabling the (very verbose) Qiskit logs
+logging.basicConfig(format="%(message)s")
+logging.getLogger(__package__).setLevel(logging.INFO)
+
 if args.mode == "FFP" and not args.position:
     parser.error("specifying a starting position is required in FFP mode. See help")
 
 if len(args.x) != len(args.y):
     parser.error("x and y inputs must have the same length")
 
-if 2 ** (log2(len(args.x)).astype(int)) != len(args.x):
+if not _is_pow2(len(args.x)):
     parser.error("input strings length must be a power of 2")
 
-# if 2 ** (log2(args.length).astype(int)) != args.length:
+# if not _is_pow2(args.length):
 #     parser.error("length must be a power of 2")
 
+try:
+    _opt_levels = tuple(int(level) for level in args.opt_levels.split(","))
+except ValueError:
+    parser.error("optimization levels must be comma separated integers")
+if not all(0 <= level <= 3 for level in _opt_levels):
+    parser.error("optimization levels must be between 0 and 3")
+
+if args.batch_size < 1:
+    parser.error("batch size must be a positive integer")
+
 if not args.token and not args.tokenpath:
     parser.error("IBM Quantum Platform API token is required")
 
-_token = args.token or open(args.tokenpath, "r").read().strip()
+if args.token:
+    _token = args.token
+else:
+    # a valid token is 128 characters long, there is no need to read more than that
+    with open(args.tokenpath, "rb") as f:
+        _token = f.read(256).strip()
+    try:
+        _token = _token.decode("ascii")
+    except UnicodeDecodeError:
+        parser.error(
+            "invalid IBM Quantum Platform API token (must be convertible to hex)"
+        )
 
 if len(_token) != 128:
     parser.error(
         "invalid IBM Quantum Platform API token: (must be a 128 hex digit number)"
     )
-try:
-    int(f"0x{_token}", base=16)
-except:
+if not _TOKEN_RE.fullmatch(_token):
     parser.error("invalid IBM Quantum Platform API token (must be convertible to hex)")
 
 print(
@@ -75,5 +123,15 @@ else:
 print(f"Building {args.mode} algorithm circuit...")
 fsm = fsm.build()
 
+if args.draw != "none":
+    print(f"Drawing circuit ({args.draw})...")
+    fsm.draw(output=args.draw)
+
 print(f"Executing {'locally' if args.local else 'remotely'}...")
-fsm.execute(str(_token), iterations=10000, local=args.local)
+fsm.execute(
+    str(_token),
+    iterations=10000,
+    local=args.local,
+    batch_size=args.batch_size,
+    optimization_levels=_opt_levels,
+)
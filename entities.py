@@ -1,6 +1,8 @@
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import Callable, List
+from itertools import chain
+from typing import Callable, List, Tuple
+from qiskit.circuit import Qubit
 from qiskit.circuit.quantumcircuit import QubitSpecifier, Gate, QuantumRegister
 
 
@@ -10,15 +12,31 @@ class FSMMode(Enum):
     SFSC = "SFSC"
 
 
-@dataclass
+@dataclass(slots=True)
 class FSMGateControl:
     qubit: QubitSpecifier
     reverse: bool
 
 
-@dataclass
+@dataclass(slots=True)
 class FSMGate:
     op: Callable[..., Gate]
     regs: List[QuantumRegister]
     controls: List[FSMGateControl] = field(default_factory=list)
     params: dict = field(default_factory=dict)
+    flat_qubits: Tuple[Qubit, ...] = field(init=False, repr=False)
+    ctrl_qubits: Tuple[QubitSpecifier, ...] = field(init=False, repr=False)
+    ctrl_state: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # registers and controls are unpacked once here so that applying the gate
+        # does not need to walk them again
+        self.flat_qubits = tuple(
+            chain.from_iterable(
+                (reg,) if isinstance(reg, Qubit) else reg for reg in self.regs
+            )
+        )
+        self.ctrl_qubits = tuple(ctrl.qubit for ctrl in self.controls)
+        self.ctrl_state = "".join(
+            "0" if ctrl.reverse else "1" for ctrl in self.controls
+        )
@@ -6,19 +6,66 @@ from qiskit.circuit import (
     QuantumRegister,
     Qubit,
 )
+from collections import OrderedDict
+from hashlib import sha256
 from typing import Dict, List
-from numpy import floor, log2
-from .entities import FSMGate, FSMGateControl, FSMMode
+import logging
+import os
+from .entities import FSMGate, FSMMode
 from .gates import (
-    bitwise_and,
+    bitwise_cand,
     extend,
     match,
     unary_or,
-    copy,
+    rccopy,
+    crot,
     reverse,
-    rot,
 )
 
+logger = logging.getLogger(__name__)
+
+_TRANSPILE_CACHE_DIR = "_transpile_cache"
+_TRANSPILE_CACHE_SIZE = 16
+# built gates circuits keyed by (input size, d register size, mode), from the least to the most recently used
+_BUILD_CACHE: "OrderedDict[tuple, QuantumCircuit]" = OrderedDict()
+_BUILD_CACHE_SIZE = 16
+# preset pass managers keyed by (backend name, optimization level, layout method)
+_PM_CACHE: Dict[tuple, "PassManager"] = {}
+# Aer simulators keyed by simulation method
+_SIMULATORS: Dict[str, "AerSimulator"] = {}
+# runtime services keyed by API token, None until the first remote execution with that token
+_SERVICES: Dict[str, "QiskitRuntimeService | None"] = {}
+
+
+def _cancellation_pass_manager(target):
+    """Creates a pass manager removing the redundant gates left by the FSM gates boundaries.
+
+    Many of the gates used to build the circuit begin and end with layers of self-inverse gates
+    (e.g. the X gates in `match` and `unary_or`), which cancel out once the circuit is unrolled.
+
+    Args:
+        - `target` (Target): target of the backend the circuit is transpiled for
+
+    Returns:
+        - `PassManager`: cancellation and single-qubit gates merging passes"""
+    from qiskit.circuit.library import CXGate, HGate, SwapGate, XGate
+    from qiskit.transpiler import PassManager
+    from qiskit.transpiler.passes import (
+        CommutativeCancellation,
+        InverseCancellation,
+        Optimize1qGatesDecomposition,
+    )
+
+    return PassManager(
+        [
+            InverseCancellation([CXGate(), HGate(), SwapGate(), XGate()]),
+            CommutativeCancellation(),
+            # the circuit is not laid out yet, so the target cannot be looked up per qubit:
+            # single-qubit runs are resynthesized in the gates supported by the whole target
+            Optimize1qGatesDecomposition(basis=list(target.operation_names)),
+        ]
+    )
+
 
 class FSM:
     def __init__(self, x: str, y: str, d: int, mode: FSMMode, backend: str, **kwargs):
@@ -43,10 +90,7 @@ class FSM:
             raise ValueError("Input strings lengths do not match")
         if d < 2:
             raise ValueError("Substring length must be at least 2")
-        try:
-            int(f"0b{x}", base=0)
-            int(f"0b{y}", base=0)
-        except:
+        if not set(x).issubset("01") or not set(y).issubset("01"):
             raise TypeError("Input strings are not in binary format")
 
         self._mode = mode
@@ -57,15 +101,15 @@ class FSM:
                     "Starting position is requested when initializing the FFP problem. Please specify the starting position using the keyword argument starting_pos"
                 )
             self._j = _pos
-            print(_pos)
+            logger.debug("Starting position: %d", _pos)
         else:
             self._j = None
         self._d = d
         self._n = len(x)
-        self._logn = floor(log2(self._n)).astype(int)
-        self._nd = floor(log2(self._d)).astype(int) + 1
+        self._logn = self._n.bit_length() - 1
+        self._nd = self._d.bit_length()
 
-        print("  Creating input registries...")
+        logger.info("  Creating input registries...")
         self._rd = QuantumRegister(self._nd, "d")
 
         self._x = x
@@ -74,18 +118,18 @@ class FSM:
 
         self._rx = QuantumRegister(self._n, "X")
         self._ry = QuantumRegister(self._n, "Y")
-        print(f"    - d: {self._nd} qubits")
-        print(f"    - x: {self._n} qubits")
-        print(f"    - y: {self._n} qubits")
+        logger.info("    - d: %d qubits", self._nd)
+        logger.info("    - x: %d qubits", self._n)
+        logger.info("    - y: %d qubits", self._n)
 
-        print(f"  Creating {self._logn+1} λ bitvectors registries...")
+        logger.info("  Creating %d λ bitvectors registries...", self._nd)
 
         # lambda registers
         self._rli: List[QuantumRegister] = [
             QuantumRegister(self._n, f"\lambda{i}") for i in range(self._nd)
         ]
 
-        print(f"  Creating {self._logn+2} D bitvectors registries...")
+        logger.info("  Creating %d D bitvectors registries...", self._nd + 1)
 
         # D registers
         self._rddinit = QuantumRegister(self._n + 1, "D-1")
@@ -94,15 +138,27 @@ class FSM:
         ]
 
         # ancillae register
-        # n * (log(d)+1) for the conjunction gate
-        # print(f"  Creating {self._n * self._nd} ancillae qubits...")
-
-        # self._ranc = QuantumRegister(self._n * self._nd, "anc")
+        # n - 1 for the internal nodes of the disjunction tree on the n + 1 qubits of the last D register
+        logger.info("  Creating %d ancillae qubits...", self._n - 1)
+        self._ranc = QuantumRegister(self._n - 1, "anc")
         # result qubit
         self._rout = QuantumRegister(1, "out")
         self._cout_outcome = ClassicalRegister(1, "found")
         # self._cout_pos = ClassicalRegister(self._n + 1, "begins")
 
+        # flattened registers, in the same order as `regs` and `cregs`, shared by all the instances
+        self._flat_regs = (
+            self._rx,
+            self._ry,
+            self._rd,
+            *self._rli,
+            self._rddinit,
+            *self._rddi,
+            self._ranc,
+            self._rout,
+        )
+        self._flat_cregs = (self._cout_outcome,)
+
         self._backend = backend
 
     @property
@@ -127,7 +183,7 @@ class FSM:
             "li": self._rli,
             "ddinit": self._rddinit,
             "ddi": self._rddi,
-            # "anc": self._ranc,
+            "anc": self._ranc,
             "out": self._rout,
         }
 
@@ -145,47 +201,37 @@ class FSM:
 
 
 class _FSMInstance:
+    __slots__ = (
+        "_ready",
+        "_measured",
+        "_fsm",
+        "_qc",
+        "_qc_measured",
+        "_qc_simulated",
+        "_x",
+        "_y",
+        "_inputs",
+    )
+
+    # transpiled gates circuits shared by all the instances, from the least to the most recently used
+    _transpile_cache: "OrderedDict[str, QuantumCircuit]" = OrderedDict()
+
     def __init__(self, fsm: FSM):
-        print("  Setting FSM instance up...")
+        logger.info("  Setting FSM instance up...")
         self._ready = False
         self._measured = False
         self._fsm = fsm
-        _regs: List[QuantumRegister] = []
-        for reg in self._fsm.regs.values():
-            if isinstance(reg, list):
-                _regs.extend(reg)
-            else:
-                _regs.append(reg)
 
-        print("  Creating circuit...")
-        self._qc = QuantumCircuit(*_regs, *list(self._fsm.cregs.values()))
+        logger.info("  Creating circuit...")
+        self._qc = QuantumCircuit(*self._fsm._flat_regs, *self._fsm._flat_cregs)
+        self._qc_measured = None
+        self._qc_simulated = None
 
-        print("  Initializing input registers...")
-        for i, bit in enumerate(bin(self.d)[2:]):
-            if bit == "1":
-                self._qc.x(self.di[i])
-
-        _inx, _iny = (self._fsm.input["x"], self._fsm.input["y"])
-        _regx, _regy = self.xy
-        for i, bit in enumerate(_inx):
-            if bit == "1":
-                self._qc.x(_regx[i])
-        for i, bit in enumerate(_iny):
-            if bit == "1":
-                self._qc.x(_regy[i])
-
-        if self.mode == FSMMode.FPM.value:
-            _ddinit = "".join(["1", "0" * self.n])
-        elif self.mode == FSMMode.FFP.value:
-            _ddinit = "".join(
-                ["0" * self.from_pos, "1", "0" * (self.n - self.from_pos)]
-            )
-        else:
-            _ddinit = "1" * (self.n + 1)
-        for i, bit in enumerate(_ddinit):
-            if bit == "1":
-                self._qc.x(self.ddinit[i])
-        print("FSM instance initialization successful.")
+        logger.info("  Initializing input registers...")
+        # the input strings are copied so that loading new ones does not affect the FSM object
+        self._x, self._y = self._fsm.input["x"], self._fsm.input["y"]
+        self._load_inputs()
+        logger.info("FSM instance initialization successful.")
 
     @property
     def ready(self) -> bool:
@@ -235,7 +281,7 @@ class _FSMInstance:
     @property
     def dsize(self) -> int:
         """Length of binary representation of d"""
-        return floor(log2(self.d)).astype(int) + 1
+        return self.di.size
 
     @property
     def di(self) -> QuantumRegister:
@@ -244,8 +290,8 @@ class _FSMInstance:
 
     @property
     def qc(self) -> QuantumCircuit:
-        """Quantum circuit instance"""
-        return self._qc
+        """Quantum circuit instance, including the input registers initialization"""
+        return self._with_inputs(self._qc)
 
     @property
     def li(self) -> List[QuantumRegister]:
@@ -262,10 +308,10 @@ class _FSMInstance:
         """Di bitvectors"""
         return self._fsm.regs["ddi"]
 
-    # @property
-    # def ancillae(self) -> QuantumRegister:
-    #     """Ancillae register to achieve parallelism in rotation"""
-    #     return self._fsm.regs["anc"]
+    @property
+    def ancillae(self) -> QuantumRegister:
+        """Ancillae register to achieve parallelism in the final disjunction"""
+        return self._fsm.regs["anc"]
 
     @property
     def out(self) -> QuantumRegister:
@@ -288,23 +334,100 @@ class _FSMInstance:
         # return self._fsm.cregs["found"], self._fsm.cregs["begins"]
         return self._fsm.cregs["found"]
 
+    def _load_inputs(self):
+        """Computes the qubits to flip to initialize the input registers.
+
+        The input registers initialization is kept apart from the gates circuit,
+        so that the latter only depends on the input size and can be reused."""
+        # all the qubits are collected first, then flipped with a single X gate call
+        # d is written from its most significant bit
+        _d, _dsize = self.d, self.dsize
+        self._inputs: List[Qubit] = [
+            self.di[i] for i in range(_dsize) if (_d >> (_dsize - 1 - i)) & 1
+        ]
+
+        _inx, _iny = (self._x, self._y)
+        _regx, _regy = self.xy
+        self._inputs.extend(_regx[i] for i, bit in enumerate(_inx) if bit == "1")
+        self._inputs.extend(_regy[i] for i, bit in enumerate(_iny) if bit == "1")
+
+        # D-1 has a single set bit unless every position is a candidate
+        if self.mode == FSMMode.FPM.value:
+            self._inputs.append(self.ddinit[0])
+        elif self.mode == FSMMode.FFP.value:
+            self._inputs.append(self.ddinit[self.from_pos])
+        else:
+            self._inputs.extend(self.ddinit)
+
+    def _with_inputs(self, qc: QuantumCircuit) -> QuantumCircuit:
+        """Returns a copy of `qc` preceded by the input registers initialization."""
+        inputs = qc.copy_empty_like()
+        if self._inputs:
+            inputs.x(self._inputs)
+        inputs.compose(qc, inplace=True)
+        return inputs
+
+    def load(self, x: str, y: str):
+        """Loads new input strings, keeping the circuit already built.
+
+        The gates circuit and its transpiled versions only depend on the input size,
+        so running the algorithm on many inputs of the same size requires neither a new build
+        nor a new transpilation.
+
+        Args:
+            - `x`, `y` (str): input strings in binary format, as long as the current ones
+
+        Raises:
+            - `ValueError` if input strings lengths do not match the current ones
+            - `TypeError` if any of the input strings is not in binary format
+
+        Returns:
+            - `self`: useful if you want to concatenate calls"""
+        if len(x) != self.n or len(y) != self.n:
+            raise ValueError("Input strings lengths do not match the instance ones")
+        if not set(x).issubset("01") or not set(y).issubset("01"):
+            raise TypeError("Input strings are not in binary format")
+
+        self._x, self._y = x, y
+        self._load_inputs()
+        self._measured = False
+        return self
+
     def build(self):
         """Builds the algorithm circuit by composing all the necessary gates in order.
 
+        The gates circuit only depends on the size of the inputs, so it is built once per size and mode
+        and composed onto the registers of later instances of the same size and mode.
+
         Note that all the gates are made to have the lowest depth possible
         at the expense of the number of lines used."""
+        # only an empty circuit can be replaced by the cached one
+        _key = (self.n, self.dsize, self.mode) if not self._qc.data else None
+        if _key in _BUILD_CACHE:
+            logger.info("  Loading gates circuit from cache...")
+            _BUILD_CACHE.move_to_end(_key)
+            # the cached circuit was built on the registers of another FSM object, so its gates
+            # are mapped by position onto the registers of this one, which have the same layout
+            self._qc.compose(_BUILD_CACHE[_key], inplace=True)
+            self._qc_measured = None
+            logger.info("Circuit building successful. Qubits: %d", self._qc.num_qubits)
+            self._ready = True
+            return self
+
         REV = FSMGate(reverse, [self.di])
-        M = FSMGate(match, [*self.xy, self.li[0]])
+        # the circuit only ever acts on computational basis states, where the relative phases
+        # of the cheaper Toffoli gates in `match` and `bitwise_cand` only add a global phase
+        M = FSMGate(match, [*self.xy, self.li[0]], params={"relative_phase": True})
 
         self.apply(REV, M)
 
-        print("  Applying extension gates to λ registries...")
+        logger.info("  Applying extension gates to λ registries...")
         for i in range(len(self.li) - 1):
             EXT = FSMGate(extend, [self.li[i], self.li[i + 1]], params={"i": i + 1})
             self.apply(EXT)
 
         # repeat for each Di register, with i = 1...log(n)
-        print(
+        logger.info(
             "  Applying controlled bitwise AND, rotation and reverse-controlled copy gates to D registries..."
         )
         _ddall = [self.ddinit, *self.ddi]
@@ -313,30 +436,29 @@ class _FSMInstance:
             # this process of subdividing ancillae register is done exactly log(n) times
             # first_anc_conj = i * self.n
 
-            ctrl = FSMGateControl(self.di[i], False)
-            rctrl = FSMGateControl(self.di[i], True)
             AND = FSMGate(
-                bitwise_and,
-                [self.li[i], _ddall[i], _ddall[i + 1]],
-                [ctrl]
+                bitwise_cand,
+                [self.di[i], self.li[i], _ddall[i], _ddall[i + 1]],
+                params={"relative_phase": True},
             )
             ROT = FSMGate(
-                rot,
-                [_ddall[i + 1]],
-                [ctrl],
-                {"k": 2**i},
+                crot,
+                [self.di[i], _ddall[i + 1]],
+                params={"k": 2**i},
             )
             CRC = FSMGate(
-                copy,
-                [_ddall[i], _ddall[i + 1]],
-                [rctrl],
+                rccopy,
+                [self.di[i], _ddall[i], _ddall[i + 1]],
             )
             self.apply(AND, ROT, CRC)
-        print(f"  Applying disjunction to D{len(self.ddi)-1}...")
-        OR = FSMGate(unary_or, [self.ddi[len(self.ddi) - 1], self.out])
+        logger.info("  Applying disjunction to D%d...", len(self.ddi) - 1)
+        OR = FSMGate(unary_or, [self.ddi[len(self.ddi) - 1], self.ancillae, self.out])
         self.apply(OR)
-        self._qc.draw(filename="FSM", fold=-1, output="mpl", initial_state=True)
-        print(f"Circuit building successful. Qubits: {len(self._qc.qubits)}")
+        if _key is not None:
+            _BUILD_CACHE[_key] = self._qc.copy()
+            if len(_BUILD_CACHE) > _BUILD_CACHE_SIZE:
+                _BUILD_CACHE.popitem(last=False)
+        logger.info("Circuit building successful. Qubits: %d", self._qc.num_qubits)
         self._ready = True
         return self
 
@@ -349,71 +471,220 @@ class _FSMInstance:
         Returns:
             - `self`: useful if you want to concatenate calls"""
 
+        self._qc_measured = None
         for gate in gates:
-            gate_qubits = []
-            for reg in gate.regs:
-                if isinstance(reg, Qubit):
-                    gate_qubits.append(reg)
-                else:
-                    gate_qubits.extend(reg)
+            gate_qubits = gate.flat_qubits
+            # everything is added in place to avoid copying the whole circuit on every gate,
+            # which is what compose() does when it returns a new circuit
             if gate.controls:
-                ctrl_qubits = [ctrl.qubit for ctrl in gate.controls]
-
-                self._qc = self._qc.compose(
+                self._qc.append(
                     gate.op(*gate.regs, **gate.params).control(
-                        len(gate.controls),
-                        ctrl_state="".join(
-                            [("0" if ctrl.reverse else "1") for ctrl in gate.controls]
-                        ),
+                        len(gate.controls), ctrl_state=gate.ctrl_state
                     ),
-                    [*ctrl_qubits, *gate_qubits],
+                    [*gate.ctrl_qubits, *gate_qubits],
                 )
             else:
-                self._qc = self._qc.compose(
-                    gate.op(*gate.regs, **gate.params), gate_qubits
+                # uncontrolled gates are inlined, so they do not need to be wrapped into
+                # a gate here and unrolled again when transpiling
+                self._qc.compose(
+                    gate.op(*gate.regs, return_circuit=True, **gate.params),
+                    gate_qubits,
+                    inplace=True,
                 )
         return self
 
+    def draw(self, output="text", filename="FSM"):
+        """Draws the whole circuit and saves it to `filename`.
+
+        Args:
+            - `output` (str): Qiskit circuit drawer output method, e.g. `text` or `mpl`
+            - `filename` (str): file path to save the drawing to"""
+        drawing = self.qc.draw(
+            output=output, filename=filename, fold=-1, initial_state=True
+        )
+        if output == "mpl":
+            # release the figure, as it can be huge for large circuits
+            import matplotlib.pyplot as plt
+
+            plt.close(drawing)
+
     def revert(self):
         """Resets circuit removing all the gates."""
-        self._qc = QuantumCircuit(list(self._fsm.regs.values()))
+        self._qc = self._qc.copy_empty_like()
+        self._qc_measured = None
+        self._ready = False
 
-    def execute(self, token: str, iterations=42, local=False):
+    def _transpile(
+        self, backend, optimization_levels=(1,), layout_method="dense"
+    ) -> QuantumCircuit:
+        """Transpiles the circuit for `backend` and initializes the input registers.
+
+        When more than one optimization level is given, the circuit is transpiled with each of them
+        and the result with the lowest depth is kept.
+
+        The gates circuit only depends on the size of the inputs, so its transpiled version is stored
+        in the `_transpile_cache` directory as a QPY file and reused by later executions on the same backend,
+        whatever the input values are. The cache key also covers the structure of the gates circuit, so changes to the gates invalidate it.
+        The most recently used ones are also kept in memory. The input initialization layer is then prepended on the physical
+        qubits chosen by the transpiler layout.
+
+        Args:
+            - `backend` (BackendV2): target backend
+            - `optimization_levels` (tuple[int]): preset pass manager optimization levels to try
+            - `layout_method` (str): preset pass manager layout method
+
+        Returns:
+            - the transpiled circuit, ready to be executed on `backend`"""
+        from qiskit import qpy
+        from qiskit.transpiler.preset_passmanagers import (
+            generate_preset_pass_manager,
+        )
+
+        # the gates themselves are part of the key, so that a change to any of them
+        # never reuses a circuit transpiled from the old ones
+        _qc = self._qc_measured
+        _structure = sha256(
+            repr(
+                [
+                    (
+                        instr.operation.name,
+                        tuple(instr.operation.params),
+                        tuple(_qc.find_bit(q).index for q in instr.qubits),
+                        tuple(_qc.find_bit(c).index for c in instr.clbits),
+                    )
+                    for instr in _qc.data
+                ]
+            ).encode()
+        ).hexdigest()
+        _key = repr(
+            (
+                self.n,
+                self.dsize,
+                _structure,
+                backend.name,
+                sorted(backend.operation_names),
+                sorted(backend.coupling_map.get_edges()),
+                tuple(sorted(optimization_levels)),
+                layout_method,
+            )
+        )
+        _digest = sha256(_key.encode()).hexdigest()
+        _path = os.path.join(_TRANSPILE_CACHE_DIR, f"{_digest}.qpy")
+        if _digest in self._transpile_cache:
+            self._transpile_cache.move_to_end(_digest)
+            transpiled = self._transpile_cache[_digest]
+        elif os.path.exists(_path):
+            logger.info("Loading transpiled circuit from cache...")
+            with open(_path, "rb") as f:
+                transpiled = qpy.load(f)[0]
+        else:
+            transpiled, depth = None, None
+            for level in sorted(optimization_levels):
+                _pm_key = (backend.name, level, layout_method)
+                pass_manager = _PM_CACHE.get(_pm_key)
+                if pass_manager is None:
+                    pass_manager = generate_preset_pass_manager(
+                        optimization_level=level,
+                        backend=backend,
+                        layout_method=layout_method,
+                    )
+                    # run the cancellation passes on the unrolled logical circuit, before layout and routing
+                    pass_manager.pre_layout = (
+                        _cancellation_pass_manager(backend.target)
+                        if pass_manager.pre_layout is None
+                        else pass_manager.pre_layout
+                        + _cancellation_pass_manager(backend.target)
+                    )
+                    _PM_CACHE[_pm_key] = pass_manager
+                candidate = pass_manager.run(self._qc_measured)
+                if len(optimization_levels) > 1:
+                    candidate_depth = candidate.depth()
+                    logger.info("  Optimization level %d: depth %d", level, candidate_depth)
+                    if depth is not None and candidate_depth >= depth:
+                        continue
+                    depth = candidate_depth
+                transpiled = candidate
+            os.makedirs(_TRANSPILE_CACHE_DIR, exist_ok=True)
+            with open(_path, "wb") as f:
+                qpy.dump(transpiled, f)
+        if _digest not in self._transpile_cache:
+            self._transpile_cache[_digest] = transpiled
+            if len(self._transpile_cache) > _TRANSPILE_CACHE_SIZE:
+                self._transpile_cache.popitem(last=False)
+
+        if not self._inputs:
+            return transpiled
+        layout = (
+            transpiled.layout.initial_index_layout()
+            if transpiled.layout
+            else list(range(transpiled.num_qubits))
+        )
+        inputs = transpiled.copy_empty_like()
+        inputs.x(
+            [layout[self._qc_measured.find_bit(qubit).index] for qubit in self._inputs]
+        )
+        return transpiled.compose(inputs, front=True)
+
+    def execute(
+        self,
+        token: str,
+        iterations=42,
+        local=False,
+        batch_size=1,
+        optimization_levels=(1,),
+    ):
         """Sends an execute request to the IBM backend and print results' quasi-probabilities distribution.
 
         Args:
             - `token` (str): IBM Quantum Platform API token
             - `iterations` (int): number of algorithm executions (shots) for job results sampling
+            - `batch_size` (int): number of independent jobs the shots are split into when executing remotely.
+            All the jobs are submitted together in a single Qiskit Runtime batch and their results are merged.
+            - `optimization_levels` (tuple[int]): transpiler optimization levels to try when executing remotely,
+            keeping the lowest depth circuit. Level 1 is usually as good as the higher ones on this circuit
+            and much faster to run: inverse and commutative cancellation run before layout at every level,
+            and the two-qubit blocks resynthesis of level 3 finds little to improve in the Toffoli and swap networks.
 
         Raises:
             - `RuntimeError`: if the circuit was not built yet
+            - `ValueError`: if `batch_size` is not between 1 and `iterations`
         """
 
-        from qiskit.transpiler.preset_passmanagers import (
-            generate_preset_pass_manager,
-        )
         from qiskit_ibm_runtime import Sampler, QiskitRuntimeService
 
-        QiskitRuntimeService.save_account(
-            channel="ibm_quantum", token=token, overwrite=True
-        )
-
         if not self.ready:
             raise RuntimeError(
                 "The circuit was not initialized yet. Use instance.build() before executing to initialize the algorithm circuit"
             )
-        self._qc.measure(self.out, self._fsm.cregs["found"])
-        # self._qc.measure(self.ddi[len(self.ddi) - 1], self._fsm.cregs["begins"])
+        if not 1 <= batch_size <= iterations:
+            raise ValueError("Batch size must be between 1 and the number of iterations")
+
+        # the account file is only rewritten the first time a token is used
+        if token not in _SERVICES:
+            QiskitRuntimeService.save_account(
+                channel="ibm_quantum", token=token, overwrite=True
+            )
+            _SERVICES[token] = None
+        # the measured circuit is only created once, so that repeated executions
+        # neither add measurements to the circuit nor miss the transpilation caches
+        if self._qc_measured is None:
+            self._qc_measured = self._qc.copy()
+            self._qc_measured.measure(self.out, self._fsm.cregs["found"])
+            # self._qc_measured.measure(self.ddi[len(self.ddi) - 1], self._fsm.cregs["begins"])
+            self._qc_simulated = None
         if not local:
-            from qiskit_ibm_runtime import Options
+            from qiskit_ibm_runtime import Batch, Options
 
-            print("Connecting to", self.backend, "with token", token)
+            logger.info("Connecting to %s...", self.backend)
 
-            service = QiskitRuntimeService(
-                channel="ibm_quantum",
-                instance="ibm-q/open/main",
-                token=str(token),
-            )
+            service = _SERVICES[token]
+            if service is None:
+                service = QiskitRuntimeService(
+                    channel="ibm_quantum",
+                    instance="ibm-q/open/main",
+                    token=str(token),
+                )
+                _SERVICES[token] = service
             backend = service.backend(self.backend)
 
             options = Options()
@@ -422,28 +693,50 @@ class _FSMInstance:
             options.resilience_level = 1
             # options.optimization_level = 2
 
-            pass_manager = generate_preset_pass_manager(
-                optimization_level=2,
-                backend=backend,
-                layout_method="dense",
-            )
-            transpiled = pass_manager.run(self._qc)
+            transpiled = self._transpile(backend, optimization_levels)
 
-            print("Circuit transpiled with depth:", transpiled.depth())
+            # computing the depth walks the whole circuit
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Circuit transpiled with depth: %d", transpiled.depth())
             # plot_circuit_layout(transpiled, backend, filename="circuit.png")
 
-            job = Sampler(backend, options=options).run(transpiled)
-            print(
-                f"Running job {job.job_id()} on backend {backend.configuration().backend_name}..."
-            )
-            result = job.result()
-            print(result.quasi_dists[0].binary_probabilities())
+            # split the shots as evenly as possible among the jobs of the batch
+            shots = [
+                iterations // batch_size + (1 if i < iterations % batch_size else 0)
+                for i in range(batch_size)
+            ]
+            with Batch(service=service, backend=backend) as batch:
+                sampler = Sampler(session=batch, options=options)
+                jobs = [sampler.run(transpiled, shots=job_shots) for job_shots in shots]
+                for job in jobs:
+                    logger.info(
+                        "Running job %s on backend %s...",
+                        job.job_id(),
+                        backend.configuration().backend_name,
+                    )
+                results = [job.result() for job in jobs]
+
+            # merge the jobs distributions weighting each one by its shots
+            dist = {}
+            for job_shots, result in zip(shots, results):
+                for outcome, prob in result.quasi_dists[0].binary_probabilities().items():
+                    dist[outcome] = dist.get(outcome, 0) + prob * job_shots / iterations
+            print(dist)
         else:
             from qiskit_aer import AerSimulator
 
-            aer_sim = AerSimulator(method="matrix_product_state")
+            aer_sim = _SIMULATORS.get("matrix_product_state")
+            if aer_sim is None:
+                aer_sim = AerSimulator(method="matrix_product_state")
+                _SIMULATORS["matrix_product_state"] = aer_sim
 
-            circuit = transpile(self.qc, aer_sim)
+            # the simulator keeps the circuit qubits, so the input initialization
+            # can be prepended to the circuit transpiled the first time
+            if self._qc_simulated is None:
+                self._qc_simulated = transpile(
+                    self._qc_measured, aer_sim, optimization_level=1
+                )
+            circuit = self._with_inputs(self._qc_simulated)
 
             result = aer_sim.run(circuit, shots=iterations).result()
             print(result.get_counts(circuit))
@@ -7,16 +7,52 @@
 # – the register disjunction operator (∨)
 # – the copy operator with reverse ctrl (C)
 
-from numpy import ceil, floor, log2
-from qiskit.circuit import QuantumCircuit, QuantumRegister, QuantumRegister, Qubit
+import os
+from functools import wraps
+from math import gcd
+from threading import Lock
+from typing import Dict
 
+from qiskit.circuit import Gate, QuantumCircuit, QuantumRegister, QuantumRegister, Qubit
+from qiskit.circuit.library import C3XGate
 
-def fanout(src: Qubit, x: QuantumRegister):
+# gates and circuits synthesized by the builders, keyed by (builder name, register sizes, i/k, flags)
+_GATE_CACHE: Dict[tuple, Gate | QuantumCircuit] = {}
+_GATE_CACHE_LOCK = Lock()
+
+
+def _cached(builder):
+    """Caches the results of `builder` in `_GATE_CACHE`, shared by all the builders of the module.
+
+    Lookups are lock-free; a miss is synthesized outside the lock, and the first result stored
+    for a key is the one every caller gets."""
+
+    @wraps(builder)
+    def wrapper(*args):
+        key = (builder.__name__, *args)
+        hit = _GATE_CACHE.get(key)
+        if hit is None:
+            hit = builder(*args)
+            with _GATE_CACHE_LOCK:
+                hit = _GATE_CACHE.setdefault(key, hit)
+        return hit
+
+    return wrapper
+
+
+def _maybe_draw(qc: QuantumCircuit, filename: str):
+    """Draws `qc` through matplotlib into `filename` only if the `QFSM_DRAW` environment variable is set."""
+    if os.environ.get("QFSM_DRAW"):
+        qc.draw(filename=filename, output="mpl")
+
+
+def fanout(src: Qubit, x: QuantumRegister, return_circuit: bool = False):
     """Fanouts `src` qubit to each qubit of `x`.
 
     Args:
         - `src` (Qubit): copy source (this is often a control bit)
         - `x` (QuantumRegister): copy destination
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
 
     Raises:
         - `NotImplementedError`: if `src` specifies more than one `Qubit` (i.e. it is not a `Qubit` instance)
@@ -25,21 +61,36 @@ def fanout(src: Qubit, x: QuantumRegister):
         raise NotImplementedError(
             "Fanout operator with more than one source is not supported"
         )
+    return _fanout(x.size, return_circuit)
+
+
+# the gates only depend on the register sizes (and on `i`/`k`), so each builder delegates
+# to a cached helper that synthesizes the circuit once on fresh registers of those sizes;
+# circuits returned with `return_circuit` are shared as well and must not be modified
+@_cached
+def _fanout(n: int, return_circuit: bool):
+    src, x = Qubit(), QuantumRegister(n, "x")
     qc = QuantumCircuit([src], x)
     qc.cx(src, x[0])
-    n = x.size
 
-    for j in (2**x for x in range(ceil(log2(n)).astype(int))):
-        # print(f"j={j}")
-        for i in range(j):
-            # print(f"(x[{i}], x[{j+i}])")
-            qc.cx(x[i], x[j + i])
+    for j in (1 << e for e in range((n - 1).bit_length())):
+        # the last layer only has n - j targets left when n is not a power of 2
+        span = min(j, n - j)
+        qc.cx(x[:span], x[j : j + span])
 
-    qc.draw(filename="fanout", output="mpl")
+    _maybe_draw(qc, "fanout")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="FAN")
 
 
-def match(x: QuantumRegister, y: QuantumRegister, result: QuantumRegister):
+def match(
+    x: QuantumRegister,
+    y: QuantumRegister,
+    result: QuantumRegister,
+    return_circuit: bool = False,
+    relative_phase: bool = False,
+):
     """Checks which qubits match between `x` and `y` and puts the result into `result` register.
 
     In FSM algorithm, it initializes λ0 bitvector.
@@ -47,37 +98,49 @@ def match(x: QuantumRegister, y: QuantumRegister, result: QuantumRegister):
     Args:
         - `x`, `y`: (`QuantumRegister`): input registers
         - `result`: (`QuantumRegister`): output register
+        - `return_circuit`: (`bool`): return the circuit instead of wrapping it into a gate
+        - `relative_phase`: (`bool`): use relative-phase Toffoli gates (3 CNOTs each instead of 6).
+        The gate is then exact only up to relative phases, i.e. only on computational basis states
 
     Raises:
         - `ValueError` if registers sizes are not equal
     """
     if x.size != y.size:
         raise ValueError("Registers size don't match")
-    #    result = QuantumRegister(x.size, name="λ0")
+    return _match(x.size, result.size, return_circuit, relative_phase)
+
+
+@_cached
+def _match(n: int, m: int, return_circuit: bool, relative_phase: bool):
+    x, y = QuantumRegister(n, "x"), QuantumRegister(n, "y")
+    result = QuantumRegister(m, "result")
     qc = QuantumCircuit(x, y, result)
+    xm, ym, xy = x[:m], y[:m], [*x, *y]
+    toffoli = qc.rccx if relative_phase else qc.ccx
 
     # n parallel Toffoli gates
-    for i in range(result.size):
-        qc.ccx(x[i], y[i], result[i])
+    toffoli(xm, ym, result)
 
     # 2n parallel X gates, one for each input qubit
-    for i in range(x.size):
-        qc.x(x[i])
-        qc.x(y[i])
+    qc.x(xy)
 
     # n parallel Toffoli gates
-    for i in range(result.size):
-        qc.ccx(x[i], y[i], result[i])
+    toffoli(xm, ym, result)
 
     # 2n parallel X gates, one for each input qubit
-    for i in range(x.size):
-        qc.x(x[i])
-        qc.x(y[i])
-    qc.draw(filename="match", output="mpl")
+    qc.x(xy)
+    _maybe_draw(qc, "match")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="M(x,y)")
 
 
-def extend(bitvec: QuantumRegister, result: QuantumRegister, i: int = 1):
+def extend(
+    bitvec: QuantumRegister,
+    result: QuantumRegister,
+    i: int = 1,
+    return_circuit: bool = False,
+):
     """Extends `bitvec` λ bitvector into `result` register to make it a λ bitvector of order `i`.
 
     It is used to extend λ`i-1` into λ`i`, where λ`i` is a bitvector whose `j`-th bit is set to 1 if substrings of length `2**i` starting from position `j` are equal (i.e. `x[j : j + 2**i - 1] == y[j : j + 2**i - 1]` ) .
@@ -86,34 +149,56 @@ def extend(bitvec: QuantumRegister, result: QuantumRegister, i: int = 1):
         - `bitvec` (QuantumRegister): input bitvector
         - `result` (QuantumRegister): output bitvector
         - `i` (int): order of extension
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
     """
+    return _extend(bitvec.size, result.size, i, return_circuit)
+
+
+@_cached
+def _extend(n: int, m: int, i: int, return_circuit: bool):
+    bitvec, result = QuantumRegister(n, "bitvec"), QuantumRegister(m, "result")
     qc = QuantumCircuit(bitvec, result)
+    stride = 1 << (i - 1)
+    # positions from `cap` onwards have no bit `stride` positions ahead to extend with
+    cap = result.size - stride
     if i != 1:
-        pos_list = range(result.size)
+        pos_list = range(cap)
     else:
         # first apply Toffoli for even positions, then apply to odd positions
-        pos_list = [
-            *[idx for idx in range(result.size) if not idx % 2],
-            *[idx for idx in range(result.size) if idx % 2],
-        ]
+        pos_list = [*range(0, cap, 2), *range(1, cap, 2)]
     for j in pos_list:
-        if j + 2 ** (i - 1) >= result.size:
-            continue
-        qc.ccx(bitvec[j], bitvec[j + 2 ** (i - 1)], result[j])
+        qc.ccx(bitvec[j], bitvec[j + stride], result[j])
 
-    qc.draw(filename=f"extend{i}", output="mpl")
+    _maybe_draw(qc, f"extend{i}")
+    if return_circuit:
+        return qc
     return qc.to_gate(label=f"EXT{i}")
 
 
-def reverse(x: QuantumRegister):
+def reverse(x: QuantumRegister, return_circuit: bool = False):
     """Reverses the qubit states of `x`.
 
     Args:
-        - `x` (QuantumRegister): register to reverse"""
+        - `x` (QuantumRegister): register to reverse
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
+    """
+    return _reverse(x.size, return_circuit)
+
+
+@_cached
+def _reverse(n: int, return_circuit: bool):
+    x = QuantumRegister(n, "x")
     qc = QuantumCircuit(x)
-    for i in range(floor(x.size / 2).astype(int)):
-        qc.swap(x[i], x[x.size - 1 - i])
-    qc.draw(filename="reverse", output="mpl")
+    # each swap is made of 3 CNOTs, and the swapped pairs are disjoint,
+    # so every CNOT layer is applied to all the pairs at once
+    if n > 1:
+        low, high = x[: n >> 1], x[: (n - 1) >> 1 : -1]
+        qc.cx(low, high)
+        qc.cx(high, low)
+        qc.cx(low, high)
+    _maybe_draw(qc, "reverse")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="REV")
 
 
@@ -123,6 +208,8 @@ def bitwise_cand_anc(
     y: QuantumRegister,
     anc: QuantumRegister,
     result: QuantumRegister,
+    return_circuit: bool = False,
+    relative_phase: bool = False,
 ):
     """Computes bitwise AND between `x` and `y` if `ctrl` state is set to 1.
 
@@ -133,64 +220,218 @@ def bitwise_cand_anc(
         - `x`, `y` (QuantumRegister): input registers
         - `anc` (QuantumRegister): ancillae register to copy `ctrl` state to
         - `result` (QuantumRegister): output register
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
+        - `relative_phase` (bool): use relative-phase 3-controlled X gates (6 CNOTs each instead of 14).
+        The gate is then exact only up to relative phases, i.e. only on computational basis states
     """
     if anc.size != x.size or anc.size != y.size - 1:
         raise ValueError("Ancillae and input register sizes are inconsistent")
+    return _bitwise_cand_anc(
+        anc.size, x.size, y.size, result.size, return_circuit, relative_phase
+    )
+
 
+@_cached
+def _bitwise_cand_anc(
+    na: int, nx: int, ny: int, m: int, return_circuit: bool, relative_phase: bool
+):
+    ctrl, anc = Qubit(), QuantumRegister(na, "anc")
+    x, y = QuantumRegister(nx, "x"), QuantumRegister(ny, "y")
+    result = QuantumRegister(m, "result")
     qc = QuantumCircuit([ctrl], anc, x, y, result)
-    qc = qc.compose(fanout(ctrl, anc), [ctrl, *anc])
-    for i in range(x.size):
-        # qc = qc.compose(C3XGate(), [anc[i], x[i], y[i], result[i]])
-        qc.mcx([anc[i], x[i], y[i]], result[i])  # problematic?
-    qc.draw(filename="bitwise_cand", output="mpl")
+    qc.compose(fanout(ctrl, anc, return_circuit=True), [ctrl, *anc], inplace=True)
+    qargs = [anc[:nx], x, y[:nx], result[:nx]]
+    if relative_phase:
+        qc.rcccx(*qargs)
+    else:
+        qc.append(C3XGate(), qargs)
+    _maybe_draw(qc, "bitwise_cand")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="CAND")
 
-def bitwise_and(x: QuantumRegister, y: QuantumRegister, result: QuantumRegister):
+def bitwise_cand(
+    ctrl: Qubit,
+    x: QuantumRegister,
+    y: QuantumRegister,
+    result: QuantumRegister,
+    return_circuit: bool = False,
+    relative_phase: bool = False,
+):
+    """Computes bitwise AND between `x` and `y` if `ctrl` state is set to 1.
+
+    Each conjunction is a single 3-controlled X gate, rather than the controlled version
+    of the `bitwise_and` gate that Qiskit would have to synthesize.
+
+    Args:
+        - `ctrl` (Qubit): control qubit
+        - `x`, `y` (QuantumRegister): input registers
+        - `result` (QuantumRegister): output register
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
+        - `relative_phase` (bool): use relative-phase 3-controlled X gates (6 CNOTs each instead of 14).
+        The gate is then exact only up to relative phases, i.e. only on computational basis states
+    """
+    return _bitwise_cand(x.size, y.size, result.size, return_circuit, relative_phase)
+
+
+@_cached
+def _bitwise_cand(nx: int, ny: int, m: int, return_circuit: bool, relative_phase: bool):
+    ctrl = Qubit()
+    x, y = QuantumRegister(nx, "x"), QuantumRegister(ny, "y")
+    result = QuantumRegister(m, "result")
+    qc = QuantumCircuit([ctrl], x, y, result)
+    # gates on 3 or more qubits only broadcast arguments of the same length
+    qargs = [[ctrl] * nx, x, y[:nx], result[:nx]]
+    if relative_phase:
+        qc.rcccx(*qargs)
+    else:
+        qc.append(C3XGate(), qargs)
+    _maybe_draw(qc, "bitwise_cand")
+    if return_circuit:
+        return qc
+    return qc.to_gate(label="CAND")
+
+
+def bitwise_and(
+    x: QuantumRegister,
+    y: QuantumRegister,
+    result: QuantumRegister,
+    return_circuit: bool = False,
+):
     """Computes bitwise AND between `x` and `y` if `ctrl` state is set to 1.
 
     Args:
         - `x`, `y` (QuantumRegister): input registers
         - `result` (QuantumRegister): output register
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
     """
+    return _bitwise_and(x.size, y.size, result.size, return_circuit)
+
+
+@_cached
+def _bitwise_and(nx: int, ny: int, m: int, return_circuit: bool):
+    x, y = QuantumRegister(nx, "x"), QuantumRegister(ny, "y")
+    result = QuantumRegister(m, "result")
     qc = QuantumCircuit(x, y, result)
-    for i in range(x.size):
-        # qc = qc.compose(C3XGate(), [anc[i], x[i], y[i], result[i]])
-        qc.mcx([x[i], y[i]], result[i])  # problematic?
-    qc.draw(filename="bitwise_and", output="mpl")
+    # a 2-controlled X is a plain Toffoli, so all of them go in a single broadcast call
+    qc.ccx(x, y[:nx], result[:nx])
+    _maybe_draw(qc, "bitwise_and")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="AND")
 
 
-def unary_or(x: QuantumRegister, r: Qubit):
+def unary_or(
+    x: QuantumRegister,
+    anc: QuantumRegister,
+    r: Qubit,
+    return_circuit: bool = False,
+):
     """Computes bitwise unary OR on `x` and puts the result in `r`.
 
+    By De Morgan's law, the negated inputs are conjoined by a balanced tree of relative-phase
+    Toffoli gates, whose internal nodes are stored in `anc`, so that the depth is logarithmic
+    in the size of `x` instead of the one of a decomposed `x.size`-controlled X gate.
+    The root is written into `r` by an exact Toffoli gate, then the tree is uncomputed:
+    the ancillae must be in the |0> state and are returned to it, and the relative phases
+    cancel out, so the gate is exact on any input.
+
     Args:
         - `x` (QuantumRegister): input register
-        - `r` (Qubit): output qubit"""
-    qc = QuantumCircuit(x, r)
-    for bit in x:
-        qc.x(bit)
-    qc.mcx([*x], r)
-    # qc = qc.compose(fanout(x[0], QuantumRegister(bits=x[1:])), [*x, r])
-    for bit in x:
-        qc.x(bit)
+        - `anc` (QuantumRegister): ancillae register for the internal nodes of the tree
+        - `r` (Qubit): output qubit
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
+
+    Raises:
+        - `ValueError` if `anc` size is not exactly `x.size - 2`
+    """
+    if anc.size != max(x.size - 2, 0):
+        raise ValueError("Ancillae and input register sizes are inconsistent")
+    return _unary_or(x.size, return_circuit)
+
+
+@_cached
+def _unary_or(n: int, return_circuit: bool):
+    x, anc = QuantumRegister(n, "x"), QuantumRegister(max(n - 2, 0), "anc")
+    r = QuantumRegister(1, "r")
+    qc = QuantumCircuit(x, anc, r)
+    # internal nodes of the tree, down to the last two
+    tree = QuantumCircuit(x, anc)
+    nodes, free = list(x), iter(anc)
+    while len(nodes) > 2:
+        pairs = len(nodes) >> 1
+        targets = [next(free) for _ in range(pairs)]
+        tree.rccx(nodes[0 : 2 * pairs : 2], nodes[1 : 2 * pairs : 2], targets)
+        nodes = [*targets, *nodes[2 * pairs :]]
+    qc.x(x)
+    qc.compose(tree, [*x, *anc], inplace=True)
+    if n == 1:
+        qc.cx(nodes[0], r[0])
+    else:
+        qc.ccx(nodes[0], nodes[1], r[0])
+    qc.compose(tree.inverse(), [*x, *anc], inplace=True)
+    qc.x(x)
     qc.x(r)
-    qc.draw(filename="unary_or", output="mpl")
+    _maybe_draw(qc, "unary_or")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="OR")
 
 
-def copy(x: QuantumRegister, result: QuantumRegister):
+def copy(x: QuantumRegister, result: QuantumRegister, return_circuit: bool = False):
     """Copies `x` qubits in `result`.
 
     Args:
         - `x` (QuantumRegister): input register
-        - `result` (QuantumRegister): output register"""
+        - `result` (QuantumRegister): output register
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
+    """
+    return _copy(x.size, result.size, return_circuit)
+
+
+@_cached
+def _copy(n: int, m: int, return_circuit: bool):
+    x, result = QuantumRegister(n, "x"), QuantumRegister(m, "result")
     qc = QuantumCircuit(x, result)
-    for i in range(result.size):
-        qc.cx(x[i], result[i])
-    qc.draw(filename="rcopy", output="mpl")
+    qc.cx(x[:m], result)
+    _maybe_draw(qc, "rcopy")
+    if return_circuit:
+        return qc
     return qc.to_gate(label="CRC")
 
 
+def rccopy(
+    ctrl: Qubit,
+    x: QuantumRegister,
+    result: QuantumRegister,
+    return_circuit: bool = False,
+):
+    """Copies `x` qubits in `result` if `ctrl` state is set to 0 (reverse control).
+
+    Args:
+        - `ctrl` (Qubit): reverse control qubit
+        - `x` (QuantumRegister): input register
+        - `result` (QuantumRegister): output register
+        - `return_circuit` (bool): return the circuit instead of wrapping it into a gate
+    """
+    return _rccopy(x.size, result.size, return_circuit)
+
+
+@_cached
+def _rccopy(n: int, m: int, return_circuit: bool):
+    ctrl = Qubit()
+    x, result = QuantumRegister(n, "x"), QuantumRegister(m, "result")
+    qc = QuantumCircuit([ctrl], x, result)
+    qc.x(ctrl)
+    # gates on 3 or more qubits only broadcast arguments of the same length
+    qc.ccx([ctrl] * m, x[:m], result)
+    qc.x(ctrl)
+    _maybe_draw(qc, "rccopy")
+    if return_circuit:
+        return qc
+    return qc.to_gate(label="RCCRC")
+
+
 # def acopy(
 #     ctrl: QuantumRegister,
 #     x: QuantumRegister,
@@ -253,24 +494,85 @@ def copy(x: QuantumRegister, result: QuantumRegister):
 #     qc.draw(filename=f"rot{k}", output="mpl")
 #     return qc.to_gate(label=f"ROT{k}")
 
-def rot(x: QuantumRegister, k: int = 1):
+def _rot_swaps(n: int, k: int):
+    """Yields the index pairs to swap to cyclically rotate a register of `n` qubits of `k` positions
+    using the reflection method.
+
+    The rotation splits into `g = gcd(n, k)` disjoint cycles, the `c`-th one made of the positions
+    `c, c + g, c + 2g, ...`, each of them rotated of `k / g` steps. Every cycle is rotated by
+    reflecting it twice, and the cycles are interleaved so that both reflections are one layer
+    of disjoint swaps, for `n - g` swaps at most.
+
+    Nothing is yielded for rotations by a multiple of `n`, which are the identity."""
+    if not k % n:
+        return
+    g = gcd(n, k)
+    size, shift = n // g, (k // g) % (n // g)
+    # t <-> -t, then t <-> shift - t, which overall moves t to t + shift
+    for reflection in (0, shift):
+        for t in range(size):
+            u = (reflection - t) % size
+            if t < u:
+                for c in range(g):
+                    yield c + t * g, c + u * g
+
+
+def rot(x: QuantumRegister, k: int = 1, return_circuit: bool = False):
     """Cyclically rotates the input register of k positions using the reflection method made with swap gates only.
     Args:
         - `x` Register to rotate
         - `k` Number of positions to rotate
+        - `return_circuit` Return the circuit instead of wrapping it into a gate
 
     Complexity:
         - volume: `O(n)`
         - depth: `Θ(1)`
     """
+    return _rot(x.size, k, return_circuit)
+
+
+@_cached
+def _rot(n: int, k: int, return_circuit: bool):
+    x = QuantumRegister(n, "x")
     qc = QuantumCircuit(x)
-    n = x.size
-    for i in range(1, ceil(n/2).astype(int)):
-        qc.swap(x[i], x[n-i])
-    for j in range(1, ceil(n/2).astype(int)):
-        qb1 = (ceil(k/2).astype(int)-j)%n
-        qb2 = (floor(k/2).astype(int)+j)%n
-        qc.swap(x[qb1], x[qb2])
-
-    qc.draw(filename=f"rot{k}", output="mpl")
+    pairs = [(x[qb1], x[qb2]) for qb1, qb2 in _rot_swaps(n, k)]
+    if pairs:
+        qc.swap(*map(list, zip(*pairs)))
+
+    _maybe_draw(qc, f"rot{k}")
+    if return_circuit:
+        return qc
     return qc.to_gate(label=f"ROT{k}")
+
+
+def crot(ctrl: Qubit, x: QuantumRegister, k: int = 1, return_circuit: bool = False):
+    """Cyclically rotates the input register of k positions if `ctrl` state is set to 1.
+
+    Same as `rot`, but each swap is replaced by a Fredkin gate on `ctrl`, which is much cheaper
+    than the decomposition Qiskit synthesizes when controlling the whole `rot` gate.
+
+    Args:
+        - `ctrl` (Qubit): control qubit
+        - `x` Register to rotate
+        - `k` Number of positions to rotate
+        - `return_circuit` Return the circuit instead of wrapping it into a gate
+
+    Complexity:
+        - volume: `O(n)`
+        - depth: `O(n)`, as all the Fredkin gates share the control qubit
+    """
+    return _crot(x.size, k, return_circuit)
+
+
+@_cached
+def _crot(n: int, k: int, return_circuit: bool):
+    ctrl, x = Qubit(), QuantumRegister(n, "x")
+    qc = QuantumCircuit([ctrl], x)
+    pairs = [(x[qb1], x[qb2]) for qb1, qb2 in _rot_swaps(n, k)]
+    if pairs:
+        qc.cswap([ctrl] * len(pairs), *map(list, zip(*pairs)))
+
+    _maybe_draw(qc, f"crot{k}")
+    if return_circuit:
+        return qc
+    return qc.to_gate(label=f"CROT{k}")